@@ -126,7 +126,7 @@ def _read_ligand_pdbqt_file(pdbqt_string, poses_to_read=-1, energy_range=-1, is_
             resname = line[17:20].strip()
             chainid = line[21].strip()
             resid = int(line[22:26].strip())
-            xyz = np.array([line[30:38].strip(), line[38:46].strip(), line[46:54].strip()], dtype=float)
+            xyz = [float(line[30:38]), float(line[38:46]), float(line[46:54])]
             try:
                 # PDBQT files from dry.py script are stripped from their partial charges. sigh...
                 partial_charges = float(line[71:77].strip())
@@ -514,6 +514,29 @@ class PDBQTMolecule:
         """
         return np.atleast_2d(self.atoms(atom_idx, only_active)['xyz'])
 
+    def positions_all_poses(self, atom_idx=None, pose_ids=None):
+        """Return coordinates (xyz) of all atoms or a certain atom for several poses at once
+
+        Unlike positions(), inactive atoms are not removed, so the same index
+        refers to the same atom in every pose.
+
+        Args:
+            atom_idx (int, list): index of one or multiple atoms (0-based)
+            pose_ids (list): index of the poses (0-based) (default: None, all poses)
+
+        Returns:
+            ndarray: 3d ndarray of coordinates (pose, atom, xyz)
+
+        """
+        if atom_idx is None:
+            atom_idx = np.arange(0, self._atoms.shape[0])
+        if pose_ids is None:
+            pose_ids = np.arange(0, self._positions.shape[0])
+        atom_idx = np.atleast_1d(atom_idx)
+        pose_ids = np.atleast_1d(np.asarray(pose_ids))
+
+        return self._positions[np.ix_(pose_ids, atom_idx)]
+
     def atoms_by_properties(self, atom_properties, only_active=True):
         """Return atom based on their properties
 
@@ -6,12 +6,26 @@
 
 
 from rdkit import Chem
-from rdkit.Geometry import Point3D
 from rdkit.Chem import AllChem
+from collections import namedtuple
 from io import StringIO
+import functools
 import json
 import os
 
+import numpy as np
+
+
+FlexresEntry = namedtuple("FlexresEntry", "smiles atom_names h_names name_set smiles_index h_parent_index expected_len")
+
+
+def _split_map(index_map):
+    """Split a flat list of 1-indexed pairs, such as smiles_index_map and
+        smiles_h_parent, into two arrays of 0-indexed integers.
+    """
+    index_map = np.asarray(index_map, dtype=np.int64) - 1
+    return index_map[0::2], index_map[1::2]
+
 
 class RDKitMolCreate:
 
@@ -159,16 +173,29 @@ class RDKitMolCreate:
         },
     }
 
+    # lookup table of flexres used by guess_flexres_smiles, maps resname to
+    # (flexres[resname], FlexresEntry). An entry is rebuilt when flexres[resname]
+    # is a different dict, call _precompute_flexres() after editing one in place
+    _flexres_fast = {}
+
     @classmethod
     def from_pdbqt_mol(cls, pdbqt_mol, only_cluster_leads=False): # TODO add pseudo-water (W atoms, variable nr each pose)
-        if only_cluster_leads and len(pdbqt_mol._pose_data["cluster_leads_sorted"]) == 0:
+        pose_data = pdbqt_mol._pose_data
+        if only_cluster_leads and len(pose_data["cluster_leads_sorted"]) == 0:
             raise RuntimeError("no cluster_leads in pdbqt_mol but only_cluster_leads=True")
+        if only_cluster_leads:
+            pose_ids = pose_data["cluster_leads_sorted"]
+        else:
+            pose_ids = range(pose_data["n_poses"])
+        smiles_all = pose_data['smiles']
+        index_map_all = pose_data['smiles_index_map']
+        h_parent_all = pose_data['smiles_h_parent']
         mol_list = []
-        for mol_index in pdbqt_mol._atom_annotations["mol_index"]:
-            smiles = pdbqt_mol._pose_data['smiles'][mol_index]
-            index_map = pdbqt_mol._pose_data['smiles_index_map'][mol_index]
-            h_parent = pdbqt_mol._pose_data['smiles_h_parent'][mol_index]
-            atom_idx = pdbqt_mol._atom_annotations["mol_index"][mol_index]
+        for mol_index, atom_idx in pdbqt_mol._atom_annotations["mol_index"].items():
+            smiles = smiles_all[mol_index]
+            index_map = index_map_all[mol_index]
+            h_parent = h_parent_all[mol_index]
+            is_flexres = False
 
             if smiles is None: # probably a flexible sidechain, but can be another ligand
                 residue_names = set()
@@ -182,27 +209,55 @@ class RDKitMolCreate:
                     if smiles is None: # failed guessing smiles for possible flexres
                         mol_list.append(None)
                         continue
+                    is_flexres = True
 
-            if only_cluster_leads:
-                pose_ids = pdbqt_mol._pose_data["cluster_leads_sorted"]
+            mol = cls._get_template_mol(smiles, is_flexres)
+            mol_idx, pdbqt_idx = _split_map(index_map)
+            h_parent_idx, h_pdbqt_idx = _split_map(h_parent)
+            if len(pose_ids) == 1:
+                # single pose, the common case: read its coordinates directly,
+                # without the (pose, atom, 3) stack and the template conformer
+                coordinates = pdbqt_mol._positions[pose_ids[0], atom_idx]
+                mol = cls.add_pose_to_mol(mol, coordinates, mol_idx, pdbqt_idx)
+                coordinates_all_poses = [coordinates]
             else:
-                pose_ids = range(pdbqt_mol._pose_data["n_poses"])
-
-            mol = Chem.MolFromSmiles(smiles)
-            coordinates_all_poses = []
-            for i in pose_ids:
-                pdbqt_mol._current_pose = i
-                coordinates = pdbqt_mol.positions(atom_idx)
-                mol = cls.add_pose_to_mol(mol, coordinates, index_map) 
-                coordinates_all_poses.append(coordinates) 
+                coordinates_all_poses = pdbqt_mol.positions_all_poses(atom_idx, pose_ids)
+                template_conf = Chem.Conformer(mol.GetNumAtoms())
+                for coordinates in coordinates_all_poses:
+                    mol = cls.add_pose_to_mol(mol, coordinates, mol_idx, pdbqt_idx, template_conf,
+                                              set_unmapped_h=False)
+                cls.set_unmapped_h_coords(mol, mol_idx)
 
             # add Hs only after all poses are added as conformers
             # because Chem.AddHs() will affect all conformers at once 
-            mol = cls.add_hydrogens(mol, coordinates_all_poses, h_parent) 
+            mol = cls.add_hydrogens(mol, coordinates_all_poses, h_parent_idx, h_pdbqt_idx)
 
             mol_list.append(mol)
         return mol_list
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _parse_smiles(smiles, is_flexres=False):
+        if not is_flexres:
+            return Chem.MolFromSmiles(smiles)
+        # the SMILES in cls.flexres have no stereocenters, skip the
+        # stereochemistry perception which dominates the parsing time
+        mol = Chem.MolFromSmiles(smiles, sanitize=False)
+        Chem.SanitizeMol(mol, sanitizeOps=Chem.SANITIZE_ALL ^ Chem.SANITIZE_CLEANUPCHIRALITY ^ Chem.SANITIZE_CLEANUP)
+        return mol
+
+    @classmethod
+    def _get_template_mol(cls, smiles, is_flexres=False):
+        """Return a new RDKit mol parsed from smiles. Parsed mols are cached
+            and a copy is returned, so callers can add conformers and
+            hydrogens without modifying the cached template.
+            Set is_flexres for SMILES from cls.flexres, which have no stereo.
+        """
+        template = cls._parse_smiles(smiles, is_flexres)
+        if template is None:
+            return None
+        return Chem.Mol(template)
+
     @classmethod
     def guess_flexres_smiles(cls, resname, atom_names):
         """ Determine a SMILES string for flexres based on atom names,
@@ -214,56 +269,57 @@ class RDKitMolCreate:
         
         Returns:
             smiles: SMILES string starting at C-alpha (excludes most of the backbone)
-            index_map: list of pairs of integers, first in pair is index in the smiles,
+            index_map: array of pairs of integers, first in pair is index in the smiles,
                        second is index of corresponding atom in atom_names         
-            h_parent: list of pairs of integers, first in pair is index of a heavy atom
+            h_parent: array of pairs of integers, first in pair is index of a heavy atom
                       in the smiles, second is index of a hydrogen in atom_names.
                       The hydrogen is bonded to the heavy atom. 
         """
 
 
 
-        if len(set(atom_names)) != len(atom_names):
+        atom_name_set = set(atom_names)
+        if len(atom_name_set) != len(atom_names):
             return None, None, None
+        name_to_pos = {name: i for i, name in enumerate(atom_names)}
         candidate_resnames = cls.ambiguous_flexres_choices.get(resname, [resname])
         for resname in candidate_resnames:
             is_match = False
-            if resname not in cls.flexres[resname]["atom_names_in_smiles_order"]:
+            flexres = cls._get_flexres_entry(resname)
+            if flexres is None:
                 continue
-            atom_names_in_smiles_order = cls.flexres[resname]["atom_names_in_smiles_order"]
-            h_to_parent_index = cls.flexres[resname]["h_to_parent_index"]
-            expected_names = atom_names_in_smiles_order + list(h_to_parent_index.keys())
-            if len(atom_names) != len(expected_names):
+            if len(atom_names) != flexres.expected_len:
                 continue
-            nr_matched_atom_names = sum([int(n in atom_names) for n in expected_names])
-            if nr_matched_atom_names == len(expected_names):
+            if flexres.name_set.issubset(atom_name_set):
                 is_match = True
                 break
         if not is_match:
             return None, None, None
         else:
-            smiles = cls.flexres[resname]["smiles"]
-            index_map = []
-            for smiles_index, name in enumerate(atom_names_in_smiles_order):
-                index_map.append(smiles_index + 1) 
-                index_map.append(atom_names.index(name) + 1)
-            h_parent = []
-            for name, smiles_index in h_to_parent_index.items():
-                h_parent.append(smiles_index + 1)
-                h_parent.append(atom_names.index(name) + 1)
+            smiles = flexres.smiles
+            atom_pos = np.array([name_to_pos[name] for name in flexres.atom_names], dtype=np.int32)
+            index_map = np.column_stack((flexres.smiles_index, atom_pos + 1)).ravel()
+            h_pos = np.array([name_to_pos[name] for name in flexres.h_names], dtype=np.int32)
+            h_parent = np.column_stack((flexres.h_parent_index, h_pos + 1)).ravel()
             return smiles, index_map, h_parent
 
     @classmethod
-    def add_pose_to_mol(cls, mol, ligand_coordinates, index_map):
+    def add_pose_to_mol(cls, mol, ligand_coordinates, mol_idx, pdbqt_idx, template_conf=None, set_unmapped_h=True):
         """add given coordinates to given molecule as new conformer.
-        Index_map maps order of coordinates to order in smile string
-        used to generate rdkit mol
+        mol_idx and pdbqt_idx map order of coordinates to order in smile
+        string used to generate rdkit mol
 
         Args:
             ligand_coordinates: 2D array of shape (nr_atom, 3).
-            index_map: list of nr_atom pairs of integers, 1-indexed.
-                       In each pair, the first int is the index in mol, and
-                       the second int is the index in ligand_coordinates
+            mol_idx: array of nr_atom integers, 0-indexed, the index in mol
+            pdbqt_idx: array of nr_atom integers, 0-indexed, the index of
+                       the corresponding atom in ligand_coordinates
+            template_conf: Chem.Conformer with as many atoms as mol, to be
+                           reused across calls (default: None, allocate a new one).
+                           It is copied by mol.AddConformer().
+            set_unmapped_h: call set_unmapped_h_coords() after adding the conformer
+                            (default: True). Pass False when adding many poses
+                            and call it once after the last one.
 
         Raises:
             RuntimeError: Will raise error if number of coordinates provided does not
@@ -271,61 +327,93 @@ class RDKitMolCreate:
         """
 
         n_atoms = mol.GetNumAtoms()
-        n_mappings = int(len(index_map) / 2)
-        conf = Chem.Conformer(n_atoms)
+        n_mappings = len(mol_idx)
+        if template_conf is None:
+            template_conf = Chem.Conformer(n_atoms)
         if n_atoms < n_mappings:
             raise RuntimeError(
                 "Given {n_coords} atom coordinates "
                 "but index_map is greater at {n_at} atoms.".format(
                     n_coords=n_atoms, n_at=n_mappings))
-        coord_is_set = [False] * n_atoms
-        for i in range(n_mappings):
-            pdbqt_index = int(index_map[i * 2 + 1]) - 1
-            mol_index = int(index_map[i * 2]) - 1
-            x, y, z = [float(coord) for coord in ligand_coordinates[pdbqt_index]]
-            conf.SetAtomPosition(mol_index, Point3D(x, y, z))
-            coord_is_set[mol_index] = True
-        mol.AddConformer(conf, assignId=True)
-        # some hydrogens (isotopes) may have no coordinate set yet
-        for i, is_set in enumerate(coord_is_set):
-            if not is_set:
-                atom = mol.GetAtomWithIdx(i)
-                if atom.GetAtomicNum() != 1:
-                    raise RuntimeError("Only H allowed to be in SMILES but not in PDBQT")
-                neigh = atom.GetNeighbors()
-                if len(neigh) != 1:
-                    raise RuntimeError("Expected H to have one neighbor")
-                AllChem.SetTerminalAtomCoords(mol, i, neigh[0].GetIdx())
+        coords = np.asarray(ligand_coordinates, dtype=np.float64)
+        positions = np.zeros((n_atoms, 3))
+        positions[mol_idx] = coords[pdbqt_idx]
+        template_conf.SetPositions(positions)
+        mol.AddConformer(template_conf, assignId=True)
+        if set_unmapped_h:
+            cls.set_unmapped_h_coords(mol, mol_idx)
         return mol
 
+    @staticmethod
+    def set_unmapped_h_coords(mol, mol_idx):
+        """some hydrogens (isotopes) may be in the SMILES but not in the PDBQT,
+            so they have no coordinates yet. Place them in all conformers of mol.
+
+        Args:
+            mol_idx: array of integers, 0-indexed, the atoms in mol that have
+                     coordinates from the PDBQT
+        """
+        coord_is_set = np.zeros(mol.GetNumAtoms(), bool)
+        coord_is_set[mol_idx] = True
+        for i in np.flatnonzero(~coord_is_set).tolist():
+            atom = mol.GetAtomWithIdx(i)
+            if atom.GetAtomicNum() != 1:
+                raise RuntimeError("Only H allowed to be in SMILES but not in PDBQT")
+            neigh = atom.GetNeighbors()
+            if len(neigh) != 1:
+                raise RuntimeError("Expected H to have one neighbor")
+            # sets the coordinates in every conformer
+            AllChem.SetTerminalAtomCoords(mol, i, neigh[0].GetIdx())
+
 
     @staticmethod
-    def add_hydrogens(mol, coordinates_list, h_parent):
+    def add_hydrogens(mol, coordinates_list, h_parent_idx, h_pdbqt_idx):
         """Add hydrogen atoms to ligand RDKit mol, adjust the positions of
             polar hydrogens to match pdbqt
+
+        Args:
+            coordinates_list: list of 2D arrays of shape (nr_atom, 3), one per conformer
+            h_parent_idx: array of integers, 0-indexed, the heavy atom index in mol
+            h_pdbqt_idx: array of integers, 0-indexed, the index of the bonded
+                         hydrogen in each array of coordinates_list
         """
-        mol = Chem.AddHs(mol, addCoords=True)
+        if len(h_parent_idx) == 0:
+            return Chem.AddHs(mol, addCoords=True)
+        mol_no_h = mol
+        # AddHs(addCoords=True) is expensive, skip it if the pdbqt
+        # may have the coordinates of all hydrogens that will be added
+        nr_added_h = sum([atom.GetTotalNumHs() for atom in mol_no_h.GetAtoms()])
+        need_coords = len(h_parent_idx) < nr_added_h
+        mol = Chem.AddHs(mol_no_h, addCoords=need_coords)
+        # topology is the same for all conformers, so match each pdbqt
+        # hydrogen to an rdkit hydrogen only once
+        parent_to_hs = {}
+        for parent_rdkit_index in set(h_parent_idx.tolist()):
+            parent_atom = mol.GetAtomWithIdx(parent_rdkit_index)
+            parent_to_hs[parent_rdkit_index] = sorted(
+                atom.GetIdx() for atom in parent_atom.GetNeighbors()
+                if atom.GetAtomicNum() == 1
+            )
+        used_count = {parent_rdkit_index: 0 for parent_rdkit_index in parent_to_hs}
+        h_rdkit_idx = []
+        for parent_rdkit_index in h_parent_idx.tolist():
+            candidate_hydrogens = parent_to_hs[parent_rdkit_index]
+            # if the pdbqt has more hydrogens than the rdkit mol the last one is reused
+            i = min(used_count[parent_rdkit_index], len(candidate_hydrogens) - 1)
+            used_count[parent_rdkit_index] += 1
+            h_rdkit_idx.append(candidate_hydrogens[i])
+        added_h = range(mol_no_h.GetNumAtoms(), mol.GetNumAtoms())
+        if not need_coords and not set(added_h).issubset(h_rdkit_idx):
+            # some added hydrogens are not in the pdbqt, so RDKit has to place them.
+            # Hydrogens are added in the same order, h_rdkit_idx remains valid
+            mol = Chem.AddHs(mol_no_h, addCoords=True)
+        h_rdkit_idx = np.array(h_rdkit_idx, dtype=np.int64)
         conformers = list(mol.GetConformers())
-        num_hydrogens = int(len(h_parent) / 2)
         for conformer_idx, atom_coordinates in enumerate(coordinates_list):
             conf = conformers[conformer_idx]
-            used_h = []
-            for i in range(num_hydrogens):
-                parent_rdkit_index = h_parent[2 * i] - 1
-                h_pdbqt_index = h_parent[2 * i + 1] - 1
-                x, y, z = [
-                    float(coord) for coord in atom_coordinates[h_pdbqt_index]
-                ]
-                parent_atom = mol.GetAtomWithIdx(parent_rdkit_index)
-                candidate_hydrogens = [
-                    atom.GetIdx() for atom in parent_atom.GetNeighbors()
-                    if atom.GetAtomicNum() == 1
-                ]
-                for h_rdkit_index in candidate_hydrogens:
-                    if h_rdkit_index not in used_h:
-                        break
-                used_h.append(h_rdkit_index)
-                conf.SetAtomPosition(h_rdkit_index, Point3D(x, y, z))
+            positions = conf.GetPositions()
+            positions[h_rdkit_idx] = np.asarray(atom_coordinates, dtype=np.float64)[h_pdbqt_idx]
+            conf.SetPositions(positions)
         return mol
 
     @staticmethod
@@ -334,15 +422,19 @@ class RDKitMolCreate:
             None's are ignored
             returns None if input is empty list or all molecules are None
         """
-        combined_mol = None
-        for mol in mol_list:
-            if mol is None:
-                continue
-            if combined_mol is None: # first iteration
-                combined_mol = mol
-            else:
-                combined_mol = Chem.CombineMols(combined_mol, mol)
-        return combined_mol
+        mol_list = [mol for mol in mol_list if mol is not None]
+        if len(mol_list) == 0:
+            return None
+        if len(mol_list) == 1:
+            return mol_list[0]
+        # InsertMol appends in place, Chem.CombineMols would copy
+        # the accumulated molecule at every step
+        combined_mol = Chem.RWMol(mol_list[0])
+        for mol in mol_list[1:]:
+            combined_mol.InsertMol(mol)
+        # InsertMol resets the ring info, restore it as parsed from SMILES
+        Chem.SanitizeMol(combined_mol, sanitizeOps=Chem.SANITIZE_SYMMRINGS)
+        return combined_mol.GetMol()
 
     @classmethod
     def _verify_flexres(cls):
@@ -352,11 +444,59 @@ class RDKitMolCreate:
             expected_names = atom_names_in_smiles_order + list(h_to_parent_index.keys())
             if len(expected_names) != len(set(expected_names)):
                 raise RuntimeError("repeated atom names in cls.flexres[%s]" % resname)
+            # parse flexres SMILES once per process
+            cls._parse_smiles(cls.flexres[resname]["smiles"], True)
+        cls._precompute_flexres()
+
+    @classmethod
+    def _get_flexres_entry(cls, resname):
+        """Return the FlexresEntry of cls.flexres[resname], or None if resname
+            is not in cls.flexres. The entry is built on first use, and again
+            if cls.flexres[resname] was replaced. Each class has its own table.
+        """
+        d = cls.flexres.get(resname)
+        if d is None:
+            return None
+        flexres_fast = cls.__dict__.get("_flexres_fast")
+        if flexres_fast is None:
+            flexres_fast = {}
+            cls._flexres_fast = flexres_fast
+        cached = flexres_fast.get(resname)
+        if cached is None or cached[0] is not d:
+            cached = (d, cls._make_flexres_entry(d))
+            flexres_fast[resname] = cached
+        return cached[1]
+
+    @classmethod
+    def _precompute_flexres(cls):
+        """Build cls._flexres_fast from cls.flexres.
+            Must be called after editing an existing entry of cls.flexres in place.
+        """
+        cls._flexres_fast = {}
+        for resname, d in cls.flexres.items():
+            cls._flexres_fast[resname] = (d, cls._make_flexres_entry(d))
+
+    @staticmethod
+    def _make_flexres_entry(d):
+        """The 1-indexed smiles indices of index_map and h_parent are stored as
+            arrays, so guess_flexres_smiles only needs to look up the positions
+            of the atom names.
+        """
+        atom_names = tuple(d["atom_names_in_smiles_order"])
+        h_names = tuple(d["h_to_parent_index"])
+        return FlexresEntry(
+            smiles=d["smiles"],
+            atom_names=atom_names,
+            h_names=h_names,
+            name_set=frozenset(atom_names + h_names),
+            smiles_index=np.arange(1, len(atom_names) + 1, dtype=np.int32),
+            h_parent_index=np.array([d["h_to_parent_index"][name] + 1 for name in h_names], dtype=np.int32),
+            expected_len=len(atom_names) + len(h_names),
+        )
 
     @staticmethod
     def write_sd_string(pdbqt_mol, only_cluster_leads=False):
         sio = StringIO()
-        f = Chem.SDWriter(sio)
         mol_list = RDKitMolCreate.from_pdbqt_mol(pdbqt_mol, only_cluster_leads)
         failures = [i for i, mol in enumerate(mol_list) if mol is None]
         combined_mol = RDKitMolCreate.combine_rdkit_mols(mol_list)
@@ -384,13 +524,23 @@ class RDKitMolCreate:
         has_all_data = True
         for _, key in props.items():
             has_all_data &= len(pdbqt_mol._pose_data[key]) == nr_conformers
-        for conformer in combined_mol.GetConformers():
+        json_per_pose = []
+        if has_all_data and len(props):
+            pose_data = pdbqt_mol._pose_data
+            json_per_pose = [
+                json.dumps({k: pose_data[v][j] for k, v in props.items()})
+                for j in pose_idxs
+            ]
+        # write the SD records directly, same format as Chem.SDWriter
+        # but without copying the molecule and its properties for each pose
+        for record_nr, conformer in enumerate(combined_mol.GetConformers(), 1):
             i = conformer.GetId()
-            j = pose_idxs[i]
-            if has_all_data:
-                data = {k: pdbqt_mol._pose_data[v][j] for k, v in props.items()}
-                if len(data): combined_mol.SetProp("meeko", json.dumps(data))
-            f.write(combined_mol, i)
-        f.close()
+            sio.write(Chem.MolToMolBlock(combined_mol, confId=i))
+            if len(json_per_pose):
+                sio.write(">  <meeko>  (%d) \n%s\n\n" % (record_nr, json_per_pose[i]))
+            sio.write("$$$$\n")
         output_string = sio.getvalue()
         return output_string, failures
+
+
+RDKitMolCreate._verify_flexres()
@@ -3,7 +3,10 @@ from meeko import PDBQTMolecule
 from meeko import MoleculePreparation
 from meeko import PDBQTWriterLegacy
 from rdkit import Chem
+from rdkit.Chem import AllChem
+import json
 import pathlib
+import numpy as np
 
 workdir = pathlib.Path(__file__)
 datadir = workdir.parents[0] / "rdkitmol_from_docking_data"
@@ -60,6 +63,96 @@ def test_arg_his():
     fpath = datadir / "arg_his.pdbqt"
     check_rdkit_bond_lengths(fpath, nr_expected_none=0, is_dlg=False, skip_typing=True)
 
+def test_guess_flexres_smiles():
+    atom_names = ["CA", "CB", "CG", "ND1", "HD1", "CE1", "NE2", "HE2", "CD2"]
+    smiles, index_map, h_parent = RDKitMolCreate.guess_flexres_smiles("HIS", atom_names)
+    assert(smiles == RDKitMolCreate.flexres["HIP"]["smiles"])
+    assert(list(index_map) == [1, 1, 2, 2, 3, 3, 4, 9, 5, 7, 6, 6, 7, 4])
+    assert(list(h_parent) == [5, 8, 7, 5])
+    assert(RDKitMolCreate.guess_flexres_smiles("HIS", atom_names[:-1]) == (None, None, None))
+    assert(RDKitMolCreate.guess_flexres_smiles("XYZ", atom_names) == (None, None, None))
+
+def test_guess_flexres_smiles_after_flexres_change():
+    atom_names = ["CA", "CB", "OX", "HX"]
+    assert(RDKitMolCreate.guess_flexres_smiles("XSR", atom_names) == (None, None, None))
+    RDKitMolCreate.flexres["XSR"] = {
+        "smiles": "CCO",
+        "atom_names_in_smiles_order": ["CA", "CB", "OX"],
+        "h_to_parent_index": {"HX": 2},
+    }
+    try:
+        smiles, index_map, h_parent = RDKitMolCreate.guess_flexres_smiles("XSR", atom_names)
+        assert(smiles == "CCO")
+        assert(list(h_parent) == [3, 4])
+        RDKitMolCreate.flexres["XSR"]["smiles"] = "CC[OH]"
+        RDKitMolCreate._precompute_flexres()
+        smiles, index_map, h_parent = RDKitMolCreate.guess_flexres_smiles("XSR", atom_names)
+        assert(smiles == "CC[OH]")
+    finally:
+        del RDKitMolCreate.flexres["XSR"]
+    assert(RDKitMolCreate.guess_flexres_smiles("XSR", atom_names) == (None, None, None))
+    # replace the value of an existing key
+    ser = RDKitMolCreate.flexres["SER"]
+    ser_names = ["CA", "CB", "OG", "HG"]
+    assert(RDKitMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CCO")
+    class SubclassMolCreate(RDKitMolCreate):
+        pass
+    assert(SubclassMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CCO")
+    RDKitMolCreate.flexres["SER"] = dict(ser, smiles="CC[OH]")
+    try:
+        assert(RDKitMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CC[OH]")
+        assert(SubclassMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CC[OH]")
+    finally:
+        RDKitMolCreate.flexres["SER"] = ser
+    assert(RDKitMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CCO")
+    assert(SubclassMolCreate.guess_flexres_smiles("SER", ser_names)[0] == "CCO")
+
+def test_positions_all_poses():
+    fpath = datadir / "arg_his.pdbqt"
+    pdbqtmol = PDBQTMolecule.from_file(fpath, skip_typing=True)
+    atom_idx = pdbqtmol._atom_annotations["mol_index"][0]
+    pose_ids = [0, 3, 5]
+    positions = pdbqtmol.positions_all_poses(atom_idx, pose_ids)
+    assert(positions.shape == (len(pose_ids), len(atom_idx), 3))
+    for i, pose_id in enumerate(pose_ids):
+        pdbqtmol._current_pose = pose_id
+        assert(np.allclose(positions[i], pdbqtmol.positions(atom_idx), atol=1e-4))
+
+def test_template_mol_not_modified():
+    fpath = datadir / "arg_his.pdbqt"
+    pdbqtmol = PDBQTMolecule.from_file(fpath, skip_typing=True)
+    first = [mol for mol in RDKitMolCreate.from_pdbqt_mol(pdbqtmol) if mol is not None]
+    second = [mol for mol in RDKitMolCreate.from_pdbqt_mol(pdbqtmol) if mol is not None]
+    assert(len(first) == len(second))
+    assert([mol.GetNumConformers() for mol in first] == [mol.GetNumConformers() for mol in second])
+    assert([mol.GetNumAtoms() for mol in first] == [mol.GetNumAtoms() for mol in second])
+
+def test_combine_rdkit_mols():
+    assert(RDKitMolCreate.combine_rdkit_mols([None, None]) is None)
+    mols = [Chem.MolFromSmiles(smiles) for smiles in ["CCO", "c1ccccc1", "C1CC1"]]
+    combined_mol = RDKitMolCreate.combine_rdkit_mols([mols[0], None, mols[1], mols[2]])
+    assert(combined_mol.GetNumAtoms() == sum([mol.GetNumAtoms() for mol in mols]))
+    assert(combined_mol.GetRingInfo().NumRings() == 2)
+    assert(Chem.MolToSmiles(combined_mol) == Chem.MolToSmiles(Chem.MolFromSmiles("CCO.c1ccccc1.C1CC1")))
+
+def test_write_sd_string():
+    fpath = datadir / "arg_his.pdbqt"
+    pdbqtmol = PDBQTMolecule.from_file(fpath, skip_typing=True)
+    n_poses = pdbqtmol._pose_data["n_poses"]
+    pdbqtmol._pose_data["cluster_id"] = [1] * n_poses
+    pdbqtmol._pose_data["rank_in_cluster"] = list(range(1, n_poses + 1))
+    pdbqtmol._pose_data["cluster_size"] = [n_poses] * n_poses
+    sd_string, failures = RDKitMolCreate.write_sd_string(pdbqtmol)
+    assert(len(failures) == 0)
+    supplier = Chem.SDMolSupplier()
+    supplier.SetData(sd_string, removeHs=False)
+    mols = [mol for mol in supplier]
+    assert(len(mols) == n_poses)
+    for i, mol in enumerate(mols):
+        data = json.loads(mol.GetProp("meeko"))
+        assert(data["rank_in_cluster"] == i + 1)
+        assert(data["free_energy"] == pdbqtmol._pose_data["free_energies"][i])
+
 
 # The following tests  generate the PDBQT and convert it back to RDKit,
 # as opposed to the tests above which start from PDBQT.
@@ -102,3 +195,59 @@ def test_small_03_two_deuterium(): run("small-03_two-deuterium.sdf")
 def test_small_03_three_deuterium(): run("small-03_three-deuterium.sdf")
 
 def test_small_04(): run("small-04.sdf", wet=True)
+
+def test_only_polar_hydrogens():
+    for smiles in ["NC(N)=O", "NC(=[NH2+])N", "OO", "OC(=O)c1ncc[nH]1"]:
+        mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+        AllChem.EmbedMolecule(mol, randomSeed=42)
+        setups = mk_prep.prepare(mol)
+        pdbqt, is_ok, error_msg = PDBQTWriterLegacy.write_string(setups[0])
+        run_from_pdbqtmol(PDBQTMolecule(pdbqt))
+
+def spy_on_addhs(monkeypatch):
+    add_coords = []
+    addhs = Chem.AddHs
+    def spy(mol, addCoords=False):
+        add_coords.append(addCoords)
+        return addhs(mol, addCoords=addCoords)
+    monkeypatch.setattr(Chem, "AddHs", spy)
+    return add_coords
+
+def test_only_polar_hydrogens_keep_pdbqt_coords(monkeypatch):
+    mol = Chem.AddHs(Chem.MolFromSmiles("NC(N)=O"))
+    AllChem.EmbedMolecule(mol, randomSeed=42)
+    setups = mk_prep.prepare(mol)
+    pdbqt, is_ok, error_msg = PDBQTWriterLegacy.write_string(setups[0])
+    pdbqtmol = PDBQTMolecule(pdbqt)
+    add_coords = spy_on_addhs(monkeypatch)
+    mol = RDKitMolCreate.from_pdbqt_mol(pdbqtmol)[0]
+    # all hydrogens are in the pdbqt, RDKit does not place any
+    assert(add_coords == [False])
+    positions = mol.GetConformer().GetPositions()
+    pdbqt_positions = pdbqtmol._positions[0]
+    assert(positions.shape == pdbqt_positions.shape)
+    assert(np.array_equal(np.unique(positions, axis=0), np.unique(pdbqt_positions, axis=0)))
+
+def test_unmatched_hydrogens_get_coords(monkeypatch):
+    # as many pdbqt hydrogens as hydrogens to add (3 on C, 1 on O),
+    # but all on the oxygen, so RDKit has to place the C-H hydrogens
+    mol = Chem.MolFromSmiles("CO")
+    conf = Chem.Conformer(2)
+    conf.SetPositions(np.array([[1.0, 1.0, 1.0], [2.4, 1.0, 1.0]]))
+    mol.AddConformer(conf, assignId=True)
+    coordinates = np.array([[1.0, 1.0, 1.0], [2.4, 1.0, 1.0], [2.8, 1.9, 1.0]])
+    h_parent_idx = np.array([1, 1, 1, 1])
+    h_pdbqt_idx = np.array([2, 2, 2, 2])
+    add_coords = spy_on_addhs(monkeypatch)
+    mol = RDKitMolCreate.add_hydrogens(mol, [coordinates], h_parent_idx, h_pdbqt_idx)
+    assert(add_coords == [False, True])
+    positions = mol.GetConformer().GetPositions()
+    for atom in mol.GetAtomWithIdx(0).GetNeighbors():
+        if atom.GetAtomicNum() != 1:
+            continue
+        xyz = positions[atom.GetIdx()]
+        assert(np.any(xyz != 0.0))
+        dist = np.linalg.norm(xyz - positions[0])
+        assert(bond_range_H[0] < dist < bond_range_H[1])
+    o_hydrogens = [a.GetIdx() for a in mol.GetAtomWithIdx(1).GetNeighbors() if a.GetAtomicNum() == 1]
+    assert(np.array_equal(positions[o_hydrogens[0]], coordinates[2]))